@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from typing import List, Optional
 
-@dataclass
+@dataclass(slots=True)
 class CompletionData:
     state: int
     timecompleted: int
@@ -12,7 +12,7 @@ class CompletionData:
     istrackeduser: bool
     uservisible: bool
 
-@dataclass
+@dataclass(slots=True)
 class Content:
     fileurl: str
     filename: str
@@ -24,7 +24,7 @@ class Content:
     isexternalfile: Optional[bool] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Module:
     id: int
     name: str
@@ -40,7 +40,7 @@ class Module:
     completiondata: Optional[CompletionData] = None
     contents: List[Content] = None 
 
-@dataclass
+@dataclass(slots=True)
 class Section:
     id: int
     name: str
@@ -52,7 +52,7 @@ class Section:
 
 ####### Container for courses
 
-@dataclass
+@dataclass(slots=True)
 class RecentCourse:
     id: int
     fullname: str
@@ -79,14 +79,14 @@ class RecentCourse:
 ########### Assignments
 
 
-@dataclass
+@dataclass(slots=True)
 class Config:
     plugin: str
     subtype: str
     name: str
     value: str
 
-@dataclass
+@dataclass(slots=True)
 class IntroAttachment:
     filename: str
     filepath: str
@@ -96,7 +96,7 @@ class IntroAttachment:
     mimetype: str
     isexternalfile: bool
 
-@dataclass
+@dataclass(slots=True)
 class Assignment:
     id: int
     cmid: int
@@ -132,7 +132,7 @@ class Assignment:
     introfiles: List
     introattachments: List[IntroAttachment]
 
-@dataclass
+@dataclass(slots=True)
 class Course:
     id: int
     fullname: str
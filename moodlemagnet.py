@@ -1,76 +1,237 @@
-import requests
+import orjson
 import os
-import re
+import shutil
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 import click
 import datastructures as ds
-import validators
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+DECODE_ERRORS = (orjson.JSONDecodeError, ijson.JSONError) if ijson else (orjson.JSONDecodeError,)
+
+DOWNLOAD_WORKERS = 16
+DOWNLOAD_BUFFER_SIZE = 1 << 20
+# (connect, read) timeouts in seconds for every request
+REQUEST_TIMEOUT = (5, 30)
+
+# Matched against the lower-cased filename
+FILE_EXTENSIONS = ('.pdf', '.py', '.csv', '.xls', '.doc', '.docx', '.docm', '.ipynb',
+                   '.jpg', '.jpeg', '.png', '.md', '.html', '.ppt', '.pptx', '.txt', '.tex')
+
+# Reserved characters for Windows
+_RESERVED_CHARS = str.maketrans('', '', '<>:"/\\|?*')
 
 def clean_filename(url):
     """
     Clean the filename extracted from the URL to remove tokens and unwanted characters.
     """
 
-    filename = url.split('/')[-1]
-    
-    filename = re.split('\?|&', filename)[0]
+    filename = url.rpartition('/')[2]
 
-    # Remove reserved characters for Windows
-    filename = re.sub(r'[<>:"/\|?*]', '', filename)
-    
-    return filename
+    filename = filename.partition('?')[0].partition('&')[0]
 
-def deserialize_section(section_data: dict) -> ds.Section:
-    modules = [deserialize_module(
-        module_data) for module_data in section_data.get('modules', [])]
+    return filename.translate(_RESERVED_CHARS)
 
-    # Extract only the fields that match the Section dataclass attributes
-    relevant_data = {
-        key: section_data[key] for key in ds.Section.__annotations__ if key in section_data}
-    relevant_data['modules'] = modules
+def create_session():
+    """
+    Create a session whose connection pool is shared by all API calls and downloads.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 
-    return ds.Section(**relevant_data)
+    session = requests.Session()
+    session.headers.update({'User-Agent': 'MoodleMagnet/1.0'})
 
-def deserialize_completion_data(completion_data_dict: dict) -> ds.CompletionData:
-    # Extract only the fields that match the CompletionData dataclass attributes
-    relevant_data = {
-        key: completion_data_dict[key] for key in ds.CompletionData.__annotations__ if key in completion_data_dict}
-    return ds.CompletionData(**relevant_data)
+    # Retry transient gateway errors instead of failing the whole file
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                  allowed_methods=frozenset(['GET', 'HEAD']))
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=DOWNLOAD_WORKERS, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+def _is_version(path, filesize, timemodified):
+    """
+    Check whether the file at path matches the size and modification time Moodle
+    reports for it. Values Moodle does not report are not compared.
+    """
+    stat = os.stat(path)
+    return filesize in (None, stat.st_size) and timemodified in (None, int(stat.st_mtime))
 
-def deserialize_module(module_data: dict) -> ds.Module:
-    relevant_data = {
-        key: module_data[key] for key in ds.Module.__annotations__ if key in module_data}
+def download_file(session, url, filename, token, filesize=None, timemodified=None):
+    """
+    Download a single file to the given path and return it.
+    Returns None without downloading if the file already exists in the version Moodle
+    reports. The body is streamed into filename + '.part', which is only renamed to
+    filename once complete. A .part file left over from the same version is resumed
+    with a Range request; any other .part file is discarded.
+    """
+    if os.path.isfile(filename) and _is_version(filename, filesize, timemodified):
+        return None
+
+    part = filename + '.part'
+    offset = 0
+    if os.path.isfile(part):
+        # An interrupted .part file is stamped with the timemodified of its version
+        if timemodified is not None and _is_version(part, None, timemodified):
+            offset = os.path.getsize(part)
+        if not 0 < offset < (filesize or 0):
+            offset = 0
+            os.remove(part)
+
+    headers = None
+    if offset:
+        # Ranges refer to the encoded body, so ask for it unencoded
+        headers = {'Range': f'bytes={offset}-', 'Accept-Encoding': 'identity'}
 
-    if 'completiondata' in module_data:
-        relevant_data['completiondata'] = deserialize_completion_data(
-            module_data['completiondata'])
+    try:
+        with _wrap_raw_errors(), session.get(url, params={'token': token}, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            # Servers without range support answer 200 with the whole file
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            with open(part, mode, buffering=DOWNLOAD_BUFFER_SIZE) as f:
+                shutil.copyfileobj(response.raw, f, length=DOWNLOAD_BUFFER_SIZE)
+    finally:
+        if timemodified is not None and os.path.isfile(part):
+            os.utime(part, (timemodified, timemodified))
+
+    os.replace(part, filename)
+    return filename
 
-    return ds.Module(**relevant_data)
+class MoodleError(Exception):
+    """
+    Raised when the webservice answers with an {"exception": ...} object instead of data.
+    """
 
+    def __init__(self, error: dict):
+        super().__init__(error.get('message'))
+        self.errorcode = error.get('errorcode')
 
-def deserialize_content(content_data: dict) -> ds.Content:
-    relevant_data = {key: content_data[key] for key in ds.Content.__annotations__ if key in content_data}
-    return ds.Content(**relevant_data)
+@contextmanager
+def _wrap_raw_errors():
+    """
+    Re-raise urllib3 errors as requests.ConnectionError. Reading response.raw
+    bypasses requests' wrapping of dropped or stalled connections.
+    """
+    try:
+        yield
+    except Exception as e:
+        # Imported only on failure so that downloads do not pay for it per file
+        from urllib3.exceptions import HTTPError
+        if not isinstance(e, HTTPError):
+            raise
 
-def deserialize_recent_course(course_data: dict) -> ds.RecentCourse:
-    relevant_data = {key: course_data[key] for key in ds.RecentCourse.__annotations__ if key in course_data}
-    return ds.RecentCourse(**relevant_data)
+        import requests
+        raise requests.ConnectionError(e) from e
 
+def iter_sections(response):
+    """
+    Yield the section dicts of a core_course_get_contents response.
+    With ijson installed they are parsed straight off the socket as they arrive.
+    """
+    if ijson is not None:
+        response.raw.decode_content = True
+        with _wrap_raw_errors():
+            events = ijson.parse(response.raw, use_float=True)
+            first = next(events)
+            events = itertools.chain([first], events)
+            if first[1] == 'start_map':
+                raise MoodleError(next(ijson.items(events, ''), {}))
+            yield from ijson.items(events, 'item')
+        return
 
-def unpack_contents(sections):
-    for section in sections:
-        for module in section.modules:
-            if isinstance(module.contents, list):
-                module.contents = [deserialize_content(content_data) if isinstance(content_data, dict) else content_data for content_data in module.contents]
+    course_contents = orjson.loads(response.content)
+    if isinstance(course_contents, dict):
+        raise MoodleError(course_contents)
+    yield from course_contents
 
+def _make_constructor(cls, name, **nested):
+    """
+    Generate a function that builds the dataclass straight from a Moodle JSON dict,
+    reading each annotated field with a single d.get() call.
+    Fields given in nested are passed through their deserializer when present.
+    """
+    args = []
+    for key in cls.__annotations__:
+        if key in nested:
+            args.append(f'{key}=_{key}(v) if (v := d.get({key!r})) is not None else None')
+        else:
+            args.append(f'{key}=d.get({key!r})')
+
+    namespace = {cls.__name__: cls, **{f'_{key}': func for key, func in nested.items()}}
+    exec(f"def {name}(d: dict) -> {cls.__name__}: return {cls.__name__}({', '.join(args)})", namespace)
+    return namespace[name]
+
+deserialize_completion_data = _make_constructor(ds.CompletionData, 'deserialize_completion_data')
+deserialize_content = _make_constructor(ds.Content, 'deserialize_content')
+deserialize_recent_course = _make_constructor(ds.RecentCourse, 'deserialize_recent_course')
+deserialize_module = _make_constructor(ds.Module, 'deserialize_module',
+                                       completiondata=deserialize_completion_data)
+_make_section = _make_constructor(ds.Section, '_make_section')
+
+def deserialize_section(section_data: dict) -> ds.Section:
+    section = _make_section(section_data)
+    section.modules = [deserialize_module(
+        module_data) for module_data in section_data.get('modules', [])]
+    return section
+
+
+def _unique_path(folder, filename, module_id, taken):
+    """
+    Return a path in folder for filename whose lower-cased form is not in taken yet,
+    appending the module id (and a counter if needed) when another download already
+    uses the name. Comparing case-insensitively keeps Windows and macOS safe.
+    """
+    path = folder + os.sep + filename
+    if path.lower() in taken:
+        stem, ext = os.path.splitext(filename)
+        path = f"{folder}{os.sep}{stem}_{module_id}{ext}"
+        n = 2
+        while path.lower() in taken:
+            path = f"{folder}{os.sep}{stem}_{module_id}_{n}{ext}"
+            n += 1
+
+    return path
+
+def unpack_contents(sections, folder):
+    """
+    Deserialize the contents of every module and return the filenames
+    alongside the (url, path, filesize, timemodified) tuples of the files to download.
+    Files linked from several modules are only downloaded once, and every
+    download gets its own path inside folder.
+    """
     filenames = []
+    # Keyed by target path so that no path is written twice in one run
+    file_urls = {}
+    seen_urls = set()
 
     for section in sections:
         for module in section.modules:
-            if module.contents: 
-                for content in module.contents:
-                    filenames.append(content.filename)
+            if not module.contents:
+                continue
+
+            contents = []
+            for content in module.contents:
+                if type(content) is dict:
+                    content = deserialize_content(content)
+                contents.append(content)
+                filenames.append(content.filename)
+                if content.filename.lower().endswith(FILE_EXTENSIONS) and content.fileurl not in seen_urls:
+                    seen_urls.add(content.fileurl)
+                    path = _unique_path(folder, clean_filename(content.fileurl), module.id, file_urls)
+                    file_urls[path.lower()] = (content.fileurl, path, content.filesize, content.timemodified)
+            module.contents = contents
 
-    return filenames
+    return filenames, list(file_urls.values())
 
 
 
@@ -84,7 +245,6 @@ BANNER =  """
 """
 
 
-click.echo(click.style(BANNER, fg='green'))
 @click.command()
 @click.option('--token', default=lambda: os.environ.get("MOODLE_TOKEN", ""), help='Insert your token from the LMS Settings Security-Key Page.')
 @click.option('--cid', required=False, help='The ID of the course to scrape data from.')
@@ -100,48 +260,53 @@ def scrape_data(cid, save_path, token, url):
 
     Provide --token and --url argument and start the dumping your moodle files.
     """
+    # Imported here so that --help and importing the helpers stay fast
+    import requests
+
+    click.echo(click.style(BANNER, fg='green'))
     
 
+    parsed_url = urlparse(url)
     if url == "":
         return click.secho("Please set a URL endpoint, either with a environment variable or via the --url argument.",
                             fg='red')
     elif token == "":
         return click.secho("Please set a MOODLE_TOKEN, either with a environment variable or via the --token argument.",
                             fg='red')
-    elif validators.url(url) is not True:
+    elif parsed_url.scheme not in ('http', 'https') or not parsed_url.netloc:
         return click.secho("Not a valid URL. Please check your MOODLE_URL.",
                             fg='red')
 
-    file_extensions = ['.pdf', '.PDF' , '.py', '.csv', '.xls', '.doc', '.docx', '.docm' '.ipynb',
-                         '.jpg', '.jpeg', '.png', '.md', '.html', '.ppt', '.pptx',
-                          '.ppt' , '.txt', '.jpg', 'jpeg', '.png', '.html', '.tex']
-
+    session = create_session()
 
 
     
     try:
     
 
-        recent_courses_url = f"{url}/moodle/webservice/rest/server.php?wstoken={token}&wsfunction=core_course_get_recent_courses&moodlewsrestformat=json"
-        assignments_content_url = f"{url}/moodle/webservice/rest/server.php?wstoken={token}&wsfunction=mod_assign_get_assignments&courseids[]={cid}&moodlewsrestformat=json"
+        webservice_url = f"{url}/moodle/webservice/rest/server.php"
         
         
-        respose_recent_courses_response = requests.get(recent_courses_url)
+        # The course list is only needed to prompt for a course ID
+        recent_courses = []
+        if not cid:
+            respose_recent_courses_response = session.get(webservice_url, params={
+                'wstoken': token,
+                'wsfunction': 'core_course_get_recent_courses',
+                'moodlewsrestformat': 'json',
+            }, timeout=REQUEST_TIMEOUT)
 
-        # Check if token is valid
-        if b"invalidtoken" in respose_recent_courses_response.content:
-            return click.secho("Your provided Token seems invalid. Please check your MOODLE_TOKEN.",
-                                fg='red')
-
-        respose_recent_courses_response.raise_for_status()
+            # Check if token is valid
+            if b"invalidtoken" in respose_recent_courses_response.content:
+                return click.secho("Your provided Token seems invalid. Please check your MOODLE_TOKEN.",
+                                    fg='red')
 
+            respose_recent_courses_response.raise_for_status()
 
+            recent_course_contents = orjson.loads(respose_recent_courses_response.content)
+            recent_courses = [deserialize_recent_course(course_data) for course_data in recent_course_contents]
 
-        respose_assignments = requests.get(assignments_content_url)
-        respose_assignments.raise_for_status()
 
-        recent_course_contents = respose_recent_courses_response.json()
-        recent_courses = [deserialize_recent_course(course_data) for course_data in recent_course_contents]
 
         course_content_folder = os.path.join(save_path, "Course_Content")
         assignments_folder = os.path.join(save_path, "Assignments")
@@ -150,7 +315,7 @@ def scrape_data(cid, save_path, token, url):
     
 
 
-        def display_courses(recent_courses, cid) -> str:
+        def display_courses(recent_courses, cid):
             if not cid:
                 click.echo("")
                 click.echo("You are in the following courses:")
@@ -168,47 +333,56 @@ def scrape_data(cid, save_path, token, url):
                 
                 value = click.prompt('Which course do you want to dump? [COURSE ID] ', type=int)
             else:
-                course_content_url = f"{url}?wstoken={token}&wsfunction=core_course_get_contents&courseid={cid}&moodlewsrestformat=json"
-                return course_content_url
+                return cid
         
             if value and value in tmp_ids:
-                cid = value
-                course_content_url = f"{url}?wstoken={token}&wsfunction=core_course_get_contents&courseid={cid}&moodlewsrestformat=json"
-                return course_content_url
+                return value
             else:
                 click.echo('Invalid input :(. Please try again')
 
-        content_url = display_courses(recent_courses, cid)
+        cid = display_courses(recent_courses, cid)
+        if cid is None:
+            return
 
 
         
-        response = requests.get(content_url)   
+        response = session.get(webservice_url, params={
+            'wstoken': token,
+            'wsfunction': 'core_course_get_contents',
+            'courseid': cid,
+            'moodlewsrestformat': 'json',
+        }, stream=True, timeout=REQUEST_TIMEOUT)
  
         response.raise_for_status()
-       
-        course_contents = response.json()
-
 
+        # Deserialize each section as soon as it has been parsed
+        sections = [deserialize_section(section_data) for section_data in iter_sections(response)]
 
-        # Deserializing the JSON data again using the adjusted functions
-        sections = [deserialize_section(section_data) for section_data in course_contents]
 
 
-
-        if not course_contents or "exception" in course_contents:
+        if not sections:
             click.echo(f"Invalid course ID or no content found for course {cid}.")
             return
 
     except requests.RequestException as e:
         click.echo(f"Error retrieving course content: {e}")
         return
+    except DECODE_ERRORS as e:
+        click.echo(f"Error decoding course content: {e}")
+        return
+    except MoodleError as e:
+        if e.errorcode == 'invalidtoken':
+            return click.secho("Your provided Token seems invalid. Please check your MOODLE_TOKEN.",
+                                fg='red')
+        click.echo(f"Invalid course ID or no content found for course {cid}.")
+        return
 
 
     ##### PRINT CONSOLE
     click.echo("Received the following content:")
     click.echo("")
-    for x in unpack_contents(sections):
-         click.echo(click.style(x, fg='white'))
+    filenames, file_urls = unpack_contents(sections, course_content_folder)
+    click.echo(click.style("\n".join(filenames), fg='white'))
     
     click.echo("")
     click.echo(click.style("Do you want to download these files now?", fg='blue'))
@@ -225,34 +399,32 @@ def scrape_data(cid, save_path, token, url):
         return
 
     ####### DOWNLOAD PART
-    file_urls = []
-    for section in course_contents:
-        for module in section.get('modules', []):
-            for content in module.get('contents', []):
-                if any(content['filename'].endswith(ext) for ext in file_extensions):
-                    file_urls.append((content['fileurl'] + f"?&token={token}", course_content_folder))
-
     if not file_urls:
         click.echo("No Files found in the specified course.")
         return
 
-    with click.progressbar(file_urls, label='Downloading Files') as bar:
-        for url,folder in bar:
-            try:
-                response = requests.get(url, stream=True)
-                response.raise_for_status()
-
-                filename = os.path.join(folder, clean_filename(url))
-                
-                with open(filename, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                        
-            except requests.RequestException as e:
-                click.echo(f"Error downloading {url}: {e}")
-            except IOError as e:
-                click.echo(f"Error saving {filename}: {e}")
-
+    pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+    try:
+        futures = {pool.submit(download_file, session, url, path, token, filesize, timemodified): (url, path)
+                   for url, path, filesize, timemodified in file_urls}
+        skipped = 0
+        with click.progressbar(length=len(futures), label='Downloading Files') as bar:
+            for future in as_completed(futures):
+                url, path = futures[future]
+                try:
+                    if future.result() is None:
+                        skipped += 1
+                except requests.RequestException as e:
+                    click.echo(f"Error downloading {url}: {e}")
+                except IOError as e:
+                    click.echo(f"Error saving {path}: {e}")
+                bar.update(1)
+    finally:
+        # On Ctrl-C only the downloads in flight finish, their .part files can be resumed
+        pool.shutdown(cancel_futures=True)
+
+    if skipped:
+        click.echo(f"Skipped {skipped} files that were already downloaded.")
     click.echo(f"Downloaded Files to {save_path}")
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlparse
+
+import orjson
+import requests
+from click.testing import CliRunner
+
+import moodlemagnet as mm
+
+
+def make_section(*modules):
+    return mm.deserialize_section({'id': 1, 'modules': [
+        {'id': module_id, 'contents': [{'filename': url.rpartition('/')[2], 'fileurl': url} for url in urls]}
+        for module_id, urls in modules
+    ]})
+
+
+class UnpackContentsTest(unittest.TestCase):
+
+    def test_same_filename_gets_unique_paths(self):
+        section = make_section((10, ['http://h/a/slides.pdf']),
+                               (11, ['http://h/b/slides.pdf', 'http://h/c/Slides.PDF']))
+
+        _, file_urls = mm.unpack_contents([section], 'out')
+
+        paths = [path for _, path, _, _ in file_urls]
+        self.assertEqual(paths, [os.path.join('out', name) for name in ('slides.pdf', 'slides_11.pdf', 'Slides_11_2.PDF')])
+
+    def test_same_url_is_downloaded_once(self):
+        section = make_section((10, ['http://h/a/slides.pdf']), (11, ['http://h/a/slides.pdf']))
+
+        _, file_urls = mm.unpack_contents([section], 'out')
+
+        self.assertEqual(len(file_urls), 1)
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """
+    Serves the bodies in files by URL path, waiting delay seconds before each response.
+    Each test gets its own subclass with fresh files, paths, ranges, delay and
+    truncate_at attributes.
+    """
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.paths.append(path)
+        time.sleep(self.delay)
+        body = self.files[path]
+        start = 0
+        if 'Range' in self.headers:
+            self.ranges.append(self.headers['Range'])
+            start = int(self.headers['Range'][len('bytes='):-1])
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        # truncate_at closes the connection early despite the Content-Length
+        self.wfile.write(body[start:self.truncate_at])
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = type('Handler', (FileHandler,), {'files': {}, 'paths': [], 'ranges': [], 'delay': 0, 'truncate_at': None})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.session = mm.create_session()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class DownloadFileTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'slides.pdf')
+
+    def download(self, body, timemodified):
+        self.handler.files = {'/slides.pdf': body}
+        self.handler.ranges = []
+        return mm.download_file(self.session, self.base_url + '/slides.pdf', self.path, 'token',
+                                len(body), timemodified)
+
+    def test_existing_version_is_skipped(self):
+        self.assertEqual(self.download(b'version a', 100), self.path)
+
+        self.assertIsNone(self.download(b'version a', 100))
+
+    def test_replaced_file_is_downloaded_again(self):
+        self.download(b'version a', 100)
+
+        self.download(b'version b', 200)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'version b')
+        self.assertEqual(self.handler.ranges, [])
+
+    def test_part_file_of_same_version_is_resumed(self):
+        with open(self.path + '.part', 'wb') as f:
+            f.write(b'version')
+        os.utime(self.path + '.part', (100, 100))
+
+        self.download(b'version a', 100)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'version a')
+        self.assertEqual(self.handler.ranges, ['bytes=7-'])
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_part_file_of_other_version_is_discarded(self):
+        with open(self.path + '.part', 'wb') as f:
+            f.write(b'old')
+        os.utime(self.path + '.part', (100, 100))
+
+        self.download(b'version b', 200)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'version b')
+        self.assertEqual(self.handler.ranges, [])
+
+    def test_connection_closed_mid_body_raises_request_exception(self):
+        self.handler.truncate_at = 4
+
+        with self.assertRaises(requests.RequestException):
+            self.download(b'version a', 100)
+
+        self.assertFalse(os.path.exists(self.path))
+
+
+@unittest.skipIf(mm.ijson is None, 'ijson is not installed')
+class IterSectionsTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.handler.files = {'/contents': b'[{"id": 1, "modules": []}, {"id": 2, "modules": []}]'}
+
+    def test_sections_are_streamed(self):
+        with self.session.get(self.base_url + '/contents', stream=True) as response:
+            sections = list(mm.iter_sections(response))
+
+        self.assertEqual([section['id'] for section in sections], [1, 2])
+
+    def test_truncated_response_raises_request_exception(self):
+        self.handler.truncate_at = 30
+
+        with self.session.get(self.base_url + '/contents', stream=True) as response:
+            with self.assertRaises(requests.RequestException):
+                list(mm.iter_sections(response))
+
+
+
+class ScrapeDataTest(ServerTestCase):
+
+    def test_interrupt_cancels_queued_downloads(self):
+        count = 3 * mm.DOWNLOAD_WORKERS
+        contents = [{'id': 1, 'modules': [{'id': 2, 'contents': [
+            {'filename': f'f{i}.pdf', 'fileurl': f'{self.base_url}/f{i}.pdf', 'filesize': 4, 'timemodified': 100}
+            for i in range(count)
+        ]}]}]
+        self.handler.files = {f'/f{i}.pdf': b'data' for i in range(count)}
+        self.handler.files['/moodle/webservice/rest/server.php'] = orjson.dumps(contents)
+        self.handler.delay = 0.2
+
+        download_file = mm.download_file
+
+        def interrupted_download(session, url, *args):
+            if url.endswith('/f0.pdf'):
+                raise KeyboardInterrupt
+            return download_file(session, url, *args)
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(mm, 'download_file', interrupted_download):
+            result = CliRunner().invoke(mm.scrape_data, ['--url', self.base_url, '--token', 'token',
+                                                         '--cid', '1', '--save_path', tmp], input='y')
+
+        self.assertIn('Aborted!', result.output)
+        fetched = [path for path in self.handler.paths if path.endswith('.pdf')]
+        self.assertLessEqual(len(fetched), mm.DOWNLOAD_WORKERS)
+
+if __name__ == '__main__':
+    unittest.main()